@@ -1,19 +1,23 @@
 import asyncio
-import json
+import codecs
+import hashlib
+import html
 import logging
 import os
 import re
+import tempfile
 import time
-from datetime import datetime
-from typing import Dict, List, Optional, Set, Union
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
 
 import aiohttp
 import feedparser
+import orjson
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
 
@@ -32,18 +36,38 @@ CHANNEL_ID = os.getenv("CHANNEL_ID")
 ADMIN_IDS = os.getenv("ADMIN_IDS", "").split(",") 
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "300"))
 FEEDS_FILE = "rss_feeds.json"
+READ_CHUNK_SIZE = 65536
+SPOOL_MAX_SIZE = 2 ** 19
+SEEN_FILE = "seen.json"
+MAX_SEEN_ARTICLES = 50000
+MAX_CONCURRENT_FETCHES = 16
+SAVE_DELAY = 1
+POST_QUEUE_SIZE = 100
+POST_DELAY = 2
+MAX_DESCRIPTION_HTML = 2000
+MAX_DESCRIPTION_TEXT = 200
+
+
+_URL_RE = re.compile(
+    r'^(https?://)?'
+    r'([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}'
+    r'(/[^/\s]*)*$'
+)
+
+_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
 
 
 router = Router()
 
-posted_articles: Set[str] = set()
+posted_articles: "OrderedDict[str, None]" = OrderedDict()
 
 
 def load_feeds() -> List[Dict[str, str]]:
     if os.path.exists(FEEDS_FILE):
         try:
-            with open(FEEDS_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            with open(FEEDS_FILE, "rb") as f:
+                return orjson.loads(f.read())
         except Exception as e:
             logger.error(f"Error loading feeds file: {str(e)}")
     return []
@@ -51,52 +75,171 @@ def load_feeds() -> List[Dict[str, str]]:
 
 def save_feeds(feeds: List[Dict[str, str]]) -> bool:
     try:
-        with open(FEEDS_FILE, "w", encoding="utf-8") as f:
-            json.dump(feeds, f, indent=2)
+        tmp_file = FEEDS_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(feeds, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_file, FEEDS_FILE)
         return True
     except Exception as e:
         logger.error(f"Error saving feeds file: {str(e)}")
         return False
 
 
+async def _load_feeds_async() -> List[Dict[str, str]]:
+    return await asyncio.to_thread(load_feeds)
+
+
+async def _save_feeds_async(feeds: List[Dict[str, str]]) -> bool:
+    return await asyncio.to_thread(save_feeds, feeds)
+
+
+def load_seen() -> None:
+    if os.path.exists(SEEN_FILE):
+        try:
+            with open(SEEN_FILE, "rb") as f:
+                for entry_id in orjson.loads(f.read()):
+                    mark_posted(entry_id)
+        except Exception as e:
+            logger.error(f"Error loading seen articles file: {str(e)}")
+
+
+def save_seen() -> bool:
+    try:
+        tmp_file = SEEN_FILE + ".tmp"
+        with open(tmp_file, "wb") as f:
+            f.write(orjson.dumps(list(posted_articles)))
+        os.replace(tmp_file, SEEN_FILE)
+        return True
+    except Exception as e:
+        logger.error(f"Error saving seen articles file: {str(e)}")
+        return False
+
+
+def is_posted(entry_id: str) -> bool:
+    if entry_id in posted_articles:
+        posted_articles.move_to_end(entry_id)
+        return True
+    return False
+
+
+def mark_posted(entry_id: str) -> None:
+    posted_articles[entry_id] = None
+    posted_articles.move_to_end(entry_id)
+    if len(posted_articles) > MAX_SEEN_ARTICLES:
+        posted_articles.popitem(last=False)
+
+
 def clean_html(html_text):
     if not html_text:
         return ""
     
-    soup = BeautifulSoup(html_text, "html.parser")
-    text = soup.get_text(separator=" ", strip=True)
+    text = html.unescape(_TAG_RE.sub(" ", html_text))
+    text = _WS_RE.sub(" ", text).strip()
     
     text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
     
     return text
 
 
+async def read_body(response: aiohttp.ClientResponse, hasher=None) -> tempfile.SpooledTemporaryFile:
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+        body.write(chunk)
+        if hasher is not None:
+            hasher.update(chunk)
+    body.seek(0)
+    return body
+
+
+def feed_headers(response: aiohttp.ClientResponse) -> Dict[str, str]:
+    # Only the charset is passed on: feedparser flags non-XML media types as
+    # bozo, and plenty of feeds are served as text/html
+    headers = {"content-location": str(response.url), "content-type": "application/xml"}
+    if response.charset:
+        try:
+            codecs.lookup(response.charset)
+        except LookupError:
+            return headers
+        headers["content-type"] += f"; charset={response.charset}"
+    return headers
+
+
+_ENTRY_TAGS = frozenset((
+    "item",
+    "{http://purl.org/rss/1.0/}item",
+    "{http://www.w3.org/2005/Atom}entry",
+))
+
+
+def parse_first_entry(body, response_headers: Optional[Dict[str, str]] = None) -> feedparser.FeedParserDict:
+    response_headers = response_headers or {}
+    content_type = response_headers.get("content-type", "")
+    charset = content_type.split("charset=", 1)[1] if "charset=" in content_type else None
+    # The rebuilt document is plain ASCII, so it only needs the base URL
+    entry_headers = {
+        "content-location": response_headers.get("content-location", ""),
+        "content-type": "application/xml; charset=utf-8",
+    }
+    ancestors = []
+    try:
+        parser = ET.XMLParser(encoding=charset)
+        for event, elem in ET.iterparse(body, events=("start", "end"), parser=parser):
+            if event == "start":
+                ancestors.append(elem)
+                continue
+            ancestors.pop()
+            if elem.tag in _ENTRY_TAGS:
+                if not ancestors:
+                    return feedparser.parse(ET.tostring(elem), response_headers=entry_headers)
+                root = leaf = ET.Element(ancestors[0].tag, ancestors[0].attrib)
+                for parent in ancestors[1:]:
+                    leaf = ET.SubElement(leaf, parent.tag, parent.attrib)
+                leaf.append(elem)
+                return feedparser.parse(ET.tostring(root), response_headers=entry_headers)
+    except (ET.ParseError, LookupError):
+        pass
+    body.seek(0)
+    return feedparser.parse(body, response_headers=response_headers)
+
+
+def normalize_channel_id(channel_id: str) -> str:
+    if channel_id.startswith('@') or channel_id.lstrip('-').isdigit():
+        return channel_id
+    return '@' + channel_id
+
+
 def is_admin(user_id: int) -> bool:
     return str(user_id) in ADMIN_IDS
 
 
 def is_valid_url(url: str) -> bool:
-    pattern = re.compile(
-        r'^(https?://)?'
-        r'([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}'
-        r'(/[^/\s]*)*$' 
-    )
-    return bool(pattern.match(url))
+    return _URL_RE.match(url) is not None
 
 
 class RSSFeedMonitor:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: Bot, channel_id: Optional[Union[int, str]] = None):
         self.bot = bot
+        self._channel_id = channel_id if channel_id is not None else normalize_channel_id(CHANNEL_ID)
         self.feeds = load_feeds()
+        self._by_url: Dict[str, Dict[str, str]] = {feed["url"]: feed for feed in self.feeds}
+        load_seen()
         self.session: Optional[aiohttp.ClientSession] = None
         self.running = False
+        self._pending_changes = 0
+        self._save_task: Optional[asyncio.Task] = None
+        self._saving = False
+        self._post_q: asyncio.Queue = asyncio.Queue(maxsize=POST_QUEUE_SIZE)
+        self._queued: Dict[str, Dict[str, str]] = {}
+        self._poster_task: Optional[asyncio.Task] = None
+        self._body_hashes: Dict[str, bytes] = {}
 
     async def start(self) -> None:
         if self.running:
             return
             
         self.running = True
-        self.session = aiohttp.ClientSession()
+        self.get_session()
+        self._poster_task = asyncio.create_task(self._poster())
         
         while self.running:
             try:
@@ -108,72 +251,198 @@ class RSSFeedMonitor:
 
     async def stop(self) -> None:
         self.running = False
+        if self._poster_task and not self._poster_task.done():
+            self._poster_task.cancel()
+            try:
+                await self._poster_task
+            except asyncio.CancelledError:
+                pass
+        if self._save_task and not self._save_task.done():
+            # Only cancel while it is still waiting; a write in progress must finish
+            if not self._saving:
+                self._save_task.cancel()
+            try:
+                await self._save_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush_feeds()
+        await asyncio.to_thread(save_seen)
+
+    async def _poster(self) -> None:
+        while True:
+            entry, entry_id, feed_config, validators = await self._post_q.get()
+            try:
+                if await self.post_entry(entry, feed_config["name"]):
+                    mark_posted(entry_id)
+                    self._apply_validators(feed_config, validators)
+                else:
+                    # Drop the cached validators so the next poll refetches the entry
+                    feed_config.pop("etag", None)
+                    feed_config.pop("last_modified", None)
+                    self._body_hashes.pop(feed_config["url"], None)
+                    self.schedule_save()
+            finally:
+                self._post_q.task_done()
+            self._queued.pop(entry_id, None)
+            await asyncio.sleep(POST_DELAY)
+
+    def _apply_validators(self, feed_config: Dict[str, str], validators: Dict[str, Optional[str]]) -> None:
+        changed = False
+        for key, value in validators.items():
+            if value == feed_config.get(key):
+                continue
+            if value:
+                feed_config[key] = value
+            else:
+                feed_config.pop(key, None)
+            changed = True
+        if changed:
+            self.schedule_save()
+
+    def _has_queued(self, feed_url: str) -> bool:
+        return any(feed["url"] == feed_url for feed in self._queued.values())
+
+    def schedule_save(self) -> None:
+        self._pending_changes += 1
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._delayed_save())
+
+    async def _delayed_save(self) -> None:
+        await asyncio.sleep(SAVE_DELAY)
+        while self._pending_changes:
+            if not await self.flush_feeds():
+                break
+
+    async def flush_feeds(self) -> bool:
+        if not self._pending_changes:
+            return True
+        pending = self._pending_changes
+        self._pending_changes = 0
+        feeds = [dict(feed) for feed in self.feeds]
+        self._saving = True
+        try:
+            saved = await _save_feeds_async(feeds)
+        finally:
+            self._saving = False
+        if not saved:
+            self._pending_changes += pending
+            logger.error(f"Failed to save {self._pending_changes} pending feed change(s) to {FEEDS_FILE}")
+        return saved
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=64,
+                    limit_per_host=8,
+                    ttl_dns_cache=300,
+                    keepalive_timeout=30,
+                ),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self.session
+
+    async def close(self) -> None:
         if self.session:
             await self.session.close()
             self.session = None
 
     async def reload_feeds(self) -> None:
-        self.feeds = load_feeds()
+        self.feeds = await _load_feeds_async()
+        self._by_url = {feed["url"]: feed for feed in self.feeds}
         logger.info(f"Reloaded {len(self.feeds)} feeds from file")
 
     async def add_feed(self, url: str, name: str) -> bool:
-        for feed in self.feeds:
-            if feed["url"] == url:
-                return False
+        if url in self._by_url:
+            return False
 
-        self.feeds.append({"url": url, "name": name})
-        
-        if save_feeds(self.feeds):
-            return True
-        return False
+        feed = {"url": url, "name": name}
+        self.feeds.append(feed)
+        self._by_url[url] = feed
+        self.schedule_save()
+        return True
 
     async def remove_feed(self, url: str) -> bool:
-        for i, feed in enumerate(self.feeds):
-            if feed["url"] == url:
-                del self.feeds[i]
-                if save_feeds(self.feeds):
-                    return True
-                break
-        return False
+        if self._by_url.pop(url, None) is None:
+            return False
+
+        self._body_hashes.pop(url, None)
+        self.feeds = list(self._by_url.values())
+        self.schedule_save()
+        return True
 
     async def check_all_feeds(self) -> None:
         if not self.feeds:
             logger.info("No feeds configured")
             return
             
-        for feed_config in self.feeds:
-            try:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+
+        async def _one(feed_config: Dict[str, str]) -> None:
+            async with sem:
                 logger.info(f"Checking feed: {feed_config['name']}")
-                await self.check_feed(feed_config["url"], feed_config["name"])
-            except Exception as e:
-                logger.error(f"Error checking feed {feed_config['name']}: {str(e)}")
+                await self.check_feed(feed_config)
+
+        feeds = list(self.feeds)
+        results = await asyncio.gather(*[_one(c) for c in feeds], return_exceptions=True)
+        for feed_config, result in zip(feeds, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error checking feed {feed_config['name']}: {str(result)}")
+
+    async def check_feed(self, feed_config: Dict[str, str]) -> None:
+        feed_url = feed_config["url"]
+        feed_name = feed_config["name"]
+        session = self.get_session()
+
+        headers = {}
+        if feed_config.get("etag"):
+            headers["If-None-Match"] = feed_config["etag"]
+        if feed_config.get("last_modified"):
+            headers["If-Modified-Since"] = feed_config["last_modified"]
 
-    async def check_feed(self, feed_url: str, feed_name: str) -> None:
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-            
         try:
-            async with self.session.get(feed_url, timeout=30) as response:
+            async with session.get(feed_url, headers=headers) as response:
+                if response.status == 304:
+                    logger.info(f"Feed not modified: {feed_name}")
+                    return
+
                 if response.status != 200:
                     logger.warning(f"Failed to fetch {feed_name}: HTTP {response.status}")
                     return
 
-                content = await response.text()
-                feed = feedparser.parse(content)
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+
+                hasher = hashlib.blake2b(digest_size=16)
+                with await read_body(response, hasher) as body:
+                    digest = hasher.digest()
+                    if self._body_hashes.get(feed_url) == digest:
+                        logger.info(f"Feed body unchanged: {feed_name}")
+                        if not self._has_queued(feed_url):
+                            self._apply_validators(feed_config, validators)
+                        return
+                    feed = parse_first_entry(body, feed_headers(response))
 
                 if feed.bozo: 
                     logger.warning(f"Error parsing feed {feed_name}: {feed.bozo_exception}")
                     return
 
-                for entry in reversed(feed.entries[:1]): 
+                self._body_hashes[feed_url] = digest
+
+                for entry in feed.entries[:1]:
                     entry_id = entry.get("id", entry.get("link", ""))
-                    if not entry_id or entry_id in posted_articles:
+                    if not entry_id or is_posted(entry_id) or entry_id in self._queued:
                         continue
 
-                    success = await self.post_entry(entry, feed_name)
-                    if success:
-                        posted_articles.add(entry_id)
-                        await asyncio.sleep(2)
+                    self._queued[entry_id] = feed_config
+                    await self._post_q.put((entry, entry_id, feed_config, validators))
+
+                # With an entry still waiting, the validators are stored by the
+                # poster once it is posted, so a crash can't skip the entry
+                if not self._has_queued(feed_url):
+                    self._apply_validators(feed_config, validators)
 
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Network error when fetching {feed_name}: {str(e)}")
@@ -184,19 +453,25 @@ class RSSFeedMonitor:
         try:
             pub_date = None
             if hasattr(entry, "published_parsed") and entry.published_parsed:
-                pub_date = datetime.fromtimestamp(time.mktime(entry.published_parsed))
+                pub_date = entry.published_parsed
             elif hasattr(entry, "updated_parsed") and entry.updated_parsed:
-                pub_date = datetime.fromtimestamp(time.mktime(entry.updated_parsed))
+                pub_date = entry.updated_parsed
 
-            date_str = f"\n📅 {pub_date.strftime('%Y-%m-%d %H:%M')}" if pub_date else ""
+            date_str = f"\n📅 {time.strftime('%Y-%m-%d %H:%M', pub_date)}" if pub_date else ""
 
             title = entry.get("title", "No title")
             link = entry.get("link", "")
             description = entry.get("description", "")
             
+            if len(description) > MAX_DESCRIPTION_HTML:
+                description = description[:MAX_DESCRIPTION_HTML]
+                # Don't leak a tag cut off by the slice into the text
+                if description.rfind("<") > description.rfind(">"):
+                    description = description[:description.rfind("<")]
+
             clean_description = clean_html(description)
             
-            short_description = clean_description[:200] + "..." if len(clean_description) > 200 else clean_description
+            short_description = clean_description[:MAX_DESCRIPTION_TEXT] + "..." if len(clean_description) > MAX_DESCRIPTION_TEXT else clean_description
 
             message = (
                 f"📢 <b>{feed_name}</b>{date_str}\n\n"
@@ -205,12 +480,8 @@ class RSSFeedMonitor:
                 f"<a href='{link}'>Read more</a>"
             )
 
-            channel_id = CHANNEL_ID
-            if not channel_id.startswith('@') and not channel_id.lstrip('-').isdigit():
-                channel_id = '@' + channel_id
-
             await self.bot.send_message(
-                chat_id=channel_id,
+                chat_id=self._channel_id,
                 text=message,
                 parse_mode=ParseMode.HTML,
                 disable_web_page_preview=False
@@ -261,27 +532,26 @@ async def cmd_add_feed(message: Message):
         await message.answer("⛔ Invalid URL format. Please provide a valid RSS feed URL.")
         return
 
+    global feed_monitor
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=30) as response:
-                if response.status != 200:
-                    await message.answer(f"⛔ Failed to fetch the feed: HTTP {response.status}")
-                    return
+        async with feed_monitor.get_session().get(url) as response:
+            if response.status != 200:
+                await message.answer(f"⛔ Failed to fetch the feed: HTTP {response.status}")
+                return
 
-                content = await response.text()
-                feed = feedparser.parse(content)
+            with await read_body(response) as body:
+                feed = feedparser.parse(body, response_headers=feed_headers(response))
 
-                if feed.bozo:
-                    await message.answer(f"⛔ Invalid RSS feed: {feed.bozo_exception}")
-                    return
+            if feed.bozo:
+                await message.answer(f"⛔ Invalid RSS feed: {feed.bozo_exception}")
+                return
 
-                if not feed.entries:
-                    await message.answer("⚠️ Warning: This feed has no entries. It might not be valid.")
+            if not feed.entries:
+                await message.answer("⚠️ Warning: This feed has no entries. It might not be valid.")
     except Exception as e:
         await message.answer(f"⛔ Error validating feed: {str(e)}")
         return
 
-    global feed_monitor
     if await feed_monitor.add_feed(url, name):
         await message.answer(f"✅ Successfully added feed: {name}")
     else:
@@ -302,12 +572,13 @@ async def cmd_list_feeds(message: Message):
         await message.answer("No RSS feeds configured.")
         return
 
-    response = "📋 Configured RSS Feeds:\n\n"
-    for i, feed in enumerate(feeds, 1):
-        response += f"{i}. <b>{feed['name']}</b>\n"
-        response += f"   URL: {feed['url']}\n\n"
+    parts = ["📋 Configured RSS Feeds:\n\n"]
+    parts.extend(
+        f"{i}. <b>{feed['name']}</b>\n   URL: {feed['url']}\n\n"
+        for i, feed in enumerate(feeds, 1)
+    )
 
-    await message.answer(response, parse_mode=ParseMode.HTML)
+    await message.answer("".join(parts), parse_mode=ParseMode.HTML)
 
 
 @router.message(Command("remove"))
@@ -346,7 +617,7 @@ async def cmd_check_feeds(message: Message):
     global feed_monitor
     try:
         await feed_monitor.check_all_feeds()
-        await message.answer("Finished checking feeds.")
+        await message.answer("Finished checking feeds. New articles will be posted shortly.")
     except Exception as e:
         await message.answer(f"Error checking feeds: {str(e)}")
 
@@ -373,11 +644,7 @@ async def main() -> None:
     logger.info(f"Admin IDs: {ADMIN_IDS}")
     
     try:
-        channel_id = CHANNEL_ID
-        if not channel_id.startswith('@') and not channel_id.lstrip('-').isdigit():
-            channel_id = '@' + channel_id
-            
-        chat = await bot.get_chat(channel_id)
+        chat = await bot.get_chat(normalize_channel_id(CHANNEL_ID))
         logger.info(f"Successfully connected to channel: {chat.title}")
     except Exception as e:
         logger.error(f"Cannot access channel {CHANNEL_ID}: {str(e)}")
@@ -385,7 +652,7 @@ async def main() -> None:
         return
     
     global feed_monitor
-    feed_monitor = RSSFeedMonitor(bot)
+    feed_monitor = RSSFeedMonitor(bot, chat.id)
     
     if not os.path.exists(FEEDS_FILE):
         save_feeds([])
@@ -399,10 +666,17 @@ async def main() -> None:
         logger.info("Stopping services...")
     finally:
         await feed_monitor.stop()
+        await feed_monitor.close()
         await bot.session.close()
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not available, using the default event loop")
+
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):